@@ -4,25 +4,21 @@ from torch import Tensor
 from shared.attention import pay_attention
 
 
-def attention(qkv_list, pe: Tensor) -> Tensor:
-    q, k, v = qkv_list
-    qkv_list.clear()
-    q_list = [q] 
-    q = None
-    q = apply_rope_(q_list, pe)
-    k_list = [k] 
-    k = None
-    k = apply_rope_(k_list, pe)
-    qkv_list = [q.transpose(1,2), k.transpose(1,2) ,v.transpose(1,2)]
-    del q,k, v
-    x = pay_attention(qkv_list).transpose(1,2)
+def attention(qkv: Tensor, pe: Tensor) -> Tensor:
+    # qkv : q, k, v packed as [B, L, 3, H, D], rope is applied to q and k at once and written back in place
+    apply_rope_(qkv[:, :, :2], pe.unsqueeze(2))
+    # q, k, v views are [B, L, H, D], the layout expected by pay_attention
+    qkv_list = list(qkv.unbind(2))
+    x = pay_attention(qkv_list)
     # x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
-    x = rearrange(x, "B H L D -> B L (H D)")
+    x = x.flatten(2)
 
     return x
 
 
 def rope(pos: Tensor, dim: int, theta: int) -> Tensor:
+    # reference implementation for a single axis, not called by the flux blocks anymore: EmbedND computes all the axes in one pass and must match
+    # the concatenation of rope() of each axis
     assert dim % 2 == 0
     scale = torch.arange(0, dim, 2, dtype=pos.dtype, device=pos.device) / dim
     omega = 1.0 / (theta**scale)
@@ -32,19 +28,15 @@ def rope(pos: Tensor, dim: int, theta: int) -> Tensor:
     return out.float()
 
 
-def apply_rope_(q_list, freqs_cis: Tensor) -> tuple[Tensor, Tensor]:
-    xq= q_list[0]
-    xqshape = xq.shape
-    xqdtype= xq.dtype
-    q_list.clear()
-    xq = xq.float().reshape(*xqshape[:-1], -1, 1, 2)
-    xq_out = freqs_cis[..., 0] * xq[..., 0]
-    xq = freqs_cis[..., 1] * xq[..., 1]
-
-    xq_out.add_(xq)
-    # xq_out = freqs_cis[..., 0] * xq_[..., 0] + freqs_cis[..., 1] * xq_[..., 1]
-
-    return xq_out.reshape(*xqshape).to(xqdtype)
+def apply_rope_(x: Tensor, freqs_cis: Tensor):
+    # rope is written back in place in x
+    # no fp32 copy of x : the products are promoted to the fp32 dtype of freqs_cis, x stays in its own dtype
+    x_ = x.reshape(*x.shape[:-1], -1, 1, 2)
+    x_out = freqs_cis[..., 0] * x_[..., 0]
+    x_out.addcmul_(freqs_cis[..., 1], x_[..., 1])
+    del x_
+    # x_out = freqs_cis[..., 0] * x_[..., 0] + freqs_cis[..., 1] * x_[..., 1]
+    x.copy_(x_out.view(x.shape))
 
 def apply_rope(xq: Tensor, xk: Tensor, freqs_cis: Tensor) -> tuple[Tensor, Tensor]:
     xq_ = xq.float().reshape(*xq.shape[:-1], -1, 1, 2)
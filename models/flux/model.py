@@ -180,17 +180,21 @@ class Flux(nn.Module):
         ids = torch.cat((txt_ids, img_ids), dim=1)
         pe = self.pe_embedder(ids)
 
+        # the modulations of all the blocks share the same activated vec, final_layer applies its own silu to the raw vec
+        vec_act = nn.functional.silu(vec)
         for block in self.double_blocks:
             if callback != None:
                 callback(-1, None, False, True)
             if pipeline._interrupt:
                 return None
-            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
+            img, txt = block(img=img, txt=txt, vec=vec_act, pe=pe)
 
+        txt_len = txt.shape[1]
         img = torch.cat((txt, img), 1)
+        del txt
         for block in self.single_blocks:
-            img = block(img, vec=vec, pe=pe)
-        img = img[:, txt.shape[1] :, ...]
+            img = block(img, vec=vec_act, pe=pe)
+        img = img.narrow(1, txt_len, img.shape[1] - txt_len)
 
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
         return img
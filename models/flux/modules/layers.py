@@ -1,11 +1,9 @@
 import math
-from dataclasses import dataclass
-
 import torch
 from einops import rearrange
 from torch import Tensor, nn
 
-from ..math import attention, rope
+from ..math import attention
 
 def get_linear_split_map():
     hidden_size = 3072
@@ -22,38 +20,56 @@ class EmbedND(nn.Module):
         self.dim = dim
         self.theta = theta
         self.axes_dim = axes_dim
+        self._omega_cache = {}
+
+    def get_omega(self, ids: Tensor) -> tuple[Tensor, Tensor]:
+        # frequencies of all the axes concatenated and the axis each of them applies to, computed once per device / dtype
+        key = (ids.device, ids.dtype)
+        omega_axes = self._omega_cache.get(key, None)
+        if omega_axes is None:
+            omega = torch.cat([1.0 / (self.theta ** (torch.arange(0, dim, 2, dtype=ids.dtype, device=ids.device) / dim)) for dim in self.axes_dim])
+            axes = torch.cat([torch.full((dim // 2,), i, dtype=torch.long, device=ids.device) for i, dim in enumerate(self.axes_dim)])
+            omega_axes = self._omega_cache[key] = (omega, axes)
+        return omega_axes
 
     def forward(self, ids: Tensor) -> Tensor:
-        n_axes = ids.shape[-1]
-        emb = torch.cat(
-            [rope(ids[..., i], self.axes_dim[i], self.theta) for i in range(n_axes)],
-            dim=-3,
-        )
+        # all the axes are processed at once, the result matches math.rope() (reference implementation) of each axis concatenated along dim -3
+        omega, axes = self.get_omega(ids)
+        out = torch.index_select(ids, -1, axes).mul_(omega)
+        cos, sin = torch.cos(out), torch.sin(out)
+        del out
+        emb = torch.stack([cos, -sin, sin, cos], dim=-1).view(*cos.shape, 2, 2).float()
+
+        # broadcast over the heads of q / k laid out as [B, L, H, D]
+        return emb.unsqueeze(2)
 
-        return emb.unsqueeze(1)
 
+_timestep_freqs_cache = {}
 
 def timestep_embedding(t: Tensor, dim, max_period=10000, time_factor: float = 1000.0):
     """
     Create sinusoidal timestep embeddings.
-    :param t: a 1-D Tensor of N indices, one per batch element.
+    :param t: a 1-D floating point Tensor of N indices, one per batch element.
                       These may be fractional.
-    :param dim: the dimension of the output.
+    :param dim: the dimension of the output, must be even.
     :param max_period: controls the minimum frequency of the embeddings.
-    :return: an (N, D) Tensor of positional embeddings.
+    :return: an (N, D) Tensor of positional embeddings, of the same dtype as t.
     """
-    t = time_factor * t
+    assert dim % 2 == 0
     half = dim // 2
-    freqs = torch.exp(-math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half).to(
-        t.device
-    )
-
-    args = t[:, None].float() * freqs[None]
-    embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
-    if dim % 2:
-        embedding = torch.cat([embedding, torch.zeros_like(embedding[:, :1])], dim=-1)
-    if torch.is_floating_point(t):
-        embedding = embedding.to(t)
+    key = (dim, max_period, t.device)
+    freqs = _timestep_freqs_cache.get(key, None)
+    if freqs is None:
+        freqs = torch.exp(-math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half).to(
+            t.device
+        )
+        _timestep_freqs_cache[key] = freqs
+
+    # as before, time_factor * t is computed in the dtype of t, then upcast to multiply the fp32 freqs; cos / sin are directly written in the dtype of t
+    args = (time_factor * t)[:, None].float() * freqs[None]
+    embedding = torch.empty((args.shape[0], dim), dtype=t.dtype, device=t.device)
+    torch.cos(args, out=embedding[:, :half])
+    torch.sin(args, out=embedding[:, half:])
     return embedding
 
 
@@ -73,11 +89,14 @@ class RMSNorm(torch.nn.Module):
         super().__init__()
         self.scale = nn.Parameter(torch.ones(dim))
 
-    def forward(self, x: Tensor):
-        x_dtype = x.dtype
-        x = x.float()
-        rrms = torch.rsqrt(torch.mean(x**2, dim=-1, keepdim=True) + 1e-6)
-        return (x * rrms).to(dtype=x_dtype) * self.scale
+    def forward(self, x: Tensor, out: Tensor) -> Tensor:
+        # normalized x is written in out (which may be x itself)
+        # the reduction is accumulated in fp32 and rrms stays fp32, so x * rrms is computed in fp32 and only rounded when written in out:
+        # no fp32 copy of x is ever materialized
+        # (nn.functional.rms_norm is not used: its eager implementation in pytorch 2.6 / 2.7 upcasts the whole input to fp32 first)
+        rrms = torch.linalg.vector_norm(x, dim=-1, keepdim=True, dtype=torch.float32)
+        rrms = rrms.square_().div_(x.shape[-1]).add_(1e-6).rsqrt_()
+        return torch.mul(x, rrms, out=out).mul_(self.scale)
 
 
 
@@ -87,47 +106,56 @@ class QKNorm(torch.nn.Module):
         self.query_norm = RMSNorm(dim)
         self.key_norm = RMSNorm(dim)
 
-    def forward(self, q: Tensor, k: Tensor, v: Tensor) -> tuple[Tensor, Tensor]:
-        if k != None:
-            return self.key_norm(k).to(v)
-        else: 
-            return self.query_norm(q).to(v)
-        # q = self.query_norm(q)
-        # k = self.key_norm(k)
-        # return q.to(v), k.to(v)
+    def forward(self, q: Tensor, k: Tensor, q_out: Tensor, k_out: Tensor):
+        # normalized q & k are written in q_out & k_out
+        self.query_norm(q, q_out)
+        self.key_norm(k, k_out)
 
 
 class SelfAttention(nn.Module):
     def __init__(self, dim: int, num_heads: int = 8, qkv_bias: bool = False):
         super().__init__()
         self.num_heads = num_heads
-        head_dim = dim // num_heads
+        self.head_dim = head_dim = dim // num_heads
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.norm = QKNorm(head_dim)
         self.proj = nn.Linear(dim, dim)
 
+    def get_qkv(self, x: Tensor, qkv: Tensor | None = None) -> Tensor:
+        # returns q (normalized), k (normalized) & v packed as [B, L, 3, H, D], written in qkv if provided
+        # qkv has been split in q, k & v by offload.split_linear_modules (see get_linear_split_map)
+        shape = x.shape[:2] + (self.num_heads, self.head_dim)
+        q = self.q(x).view(*shape)
+        k = self.k(x).view(*shape)
+        v = self.v(x).view(*shape)
+        if qkv is None:
+            qkv = torch.empty((*shape[:2], 3, *shape[2:]), dtype=v.dtype, device=v.device)
+        qkv[:, :, 2] = v
+        self.norm(q, k, qkv[:, :, 0], qkv[:, :, 1])
+        return qkv
+
     def forward(self, x: Tensor, pe: Tensor) -> Tensor:
-        raise Exception("not implemented")
-
-@dataclass
-class ModulationOut:
-    shift: Tensor
-    scale: Tensor
-    gate: Tensor
-
-
-def split_mlp(mlp, x, divide = 8):
-    x_shape = x.shape
-    x = x.view(-1, x.shape[-1])
-    chunk_size = int(x.shape[0]/divide)
-    chunk_size = int(x_shape[1]/divide)
-    x_chunks = torch.split(x, chunk_size)
-    for i, x_chunk  in enumerate(x_chunks):
-        mlp_chunk = mlp[0](x_chunk)
-        mlp_chunk = mlp[1](mlp_chunk)
-        x_chunk[...] = mlp[2](mlp_chunk)
-    return x.reshape(x_shape)      
+        qkv = self.get_qkv(x)
+        x = attention(qkv, pe=pe)
+        del qkv
+        return self.proj(x)
+
+def modulate_(x: Tensor, shift: Tensor, scale_p1: Tensor) -> Tensor:
+    # x * scale_p1 + shift computed in place in a single kernel, scale_p1 being 1 + scale
+    return torch.addcmul(shift, x, scale_p1, out=x)
+
+
+def split_mlp(mlp, x, gate, accumulator, divide = 8):
+    # accumulator += mlp(x) * gate, the gated mlp output of each chunk is directly accumulated instead of being written back in x first
+    # chunks are taken along the sequence dim so that the gate of each batch element still broadcasts
+    chunk_size = max(x.shape[1] // divide, 1)
+    x_chunks = torch.split(x, chunk_size, dim=1)
+    accumulator_chunks = torch.split(accumulator, chunk_size, dim=1)
+    for x_chunk, accumulator_chunk in zip(x_chunks, accumulator_chunks):
+        # single expression so that the bias + gelu epilogue can be fused when compiled
+        accumulator_chunk.addcmul_(mlp[2](mlp[1](mlp[0](x_chunk))), gate)
+    return accumulator
 
 class Modulation(nn.Module):
     def __init__(self, dim: int, double: bool):
@@ -136,13 +164,15 @@ class Modulation(nn.Module):
         self.multiplier = 6 if double else 3
         self.lin = nn.Linear(dim, self.multiplier * dim, bias=True)
 
-    def forward(self, vec: Tensor) -> tuple[ModulationOut, ModulationOut | None]:
-        out = self.lin(nn.functional.silu(vec))[:, None, :].chunk(self.multiplier, dim=-1)
-
-        return (
-            ModulationOut(*out[:3]),
-            ModulationOut(*out[3:]) if self.is_double else None,
-        )
+    def forward(self, vec: Tensor, silu_applied: bool = False) -> Tensor:
+        # returns a [B, multiplier, H] view of the linear output : rows are shift, 1 + scale, gate (then shift2, 1 + scale2, gate2 if double),
+        # a row is taken with a slice (mod[:, 1:2]) so that it broadcasts over the sequence dim
+        if not silu_applied:
+            vec = nn.functional.silu(vec)
+        out = self.lin(vec).view(vec.shape[0], self.multiplier, -1)
+        # 1 is added once to all the scale rows so that each modulation can use them as is
+        out[:, 1::3].add_(1)
+        return out
 
 
 class DoubleStreamBlock(nn.Module):
@@ -175,66 +205,41 @@ class DoubleStreamBlock(nn.Module):
         )
 
     def forward(self, img: Tensor, txt: Tensor, vec: Tensor, pe: Tensor) -> tuple[Tensor, Tensor]:
-        img_mod1, img_mod2 = self.img_mod(vec)
-        txt_mod1, txt_mod2 = self.txt_mod(vec)
+        # vec has already been activated once for all the blocks (see Flux.forward)
+        img_mod = self.img_mod(vec, silu_applied=True)
+        txt_mod = self.txt_mod(vec, silu_applied=True)
 
         # prepare image for attention
-        img_modulated = self.img_norm1(img)
-        img_modulated.mul_(1 + img_mod1.scale)
-        img_modulated.add_(img_mod1.shift)
-
-        shape = (*img_modulated.shape[:2], self.num_heads, int(img_modulated.shape[-1] / self.num_heads) )
-        img_q = self.img_attn.q(img_modulated).view(*shape).transpose(1,2)
-        img_k = self.img_attn.k(img_modulated).view(*shape).transpose(1,2) 
-        img_v = self.img_attn.v(img_modulated).view(*shape).transpose(1,2)
-        del img_modulated
+        img_modulated = modulate_(self.img_norm1(img), img_mod[:, 0:1], img_mod[:, 1:2])
 
-
-        img_q= self.img_attn.norm(img_q, None, img_v)
-        img_k = self.img_attn.norm(None, img_k, img_v)
+        # txt & img q, k, v are written straight into the concatenated packed buffer expected by the attention
+        txt_len = txt.shape[1]
+        qkv = torch.empty((img.shape[0], txt_len + img.shape[1], 3, self.num_heads, self.img_attn.head_dim), dtype=img_modulated.dtype, device=img_modulated.device)
+        self.img_attn.get_qkv(img_modulated, qkv[:, txt_len:])
+        del img_modulated
 
         # prepare txt for attention
-        txt_modulated = self.txt_norm1(txt)
-        txt_modulated.mul_(1 + txt_mod1.scale)
-        txt_modulated.add_(txt_mod1.shift)
-
-        shape = (*txt_modulated.shape[:2], self.num_heads, int(txt_modulated.shape[-1] / self.num_heads) )
-        txt_q = self.txt_attn.q(txt_modulated).view(*shape).transpose(1,2)
-        txt_k = self.txt_attn.k(txt_modulated).view(*shape).transpose(1,2) 
-        txt_v = self.txt_attn.v(txt_modulated).view(*shape).transpose(1,2)
-        del txt_modulated
-
+        txt_modulated = modulate_(self.txt_norm1(txt), txt_mod[:, 0:1], txt_mod[:, 1:2])
 
-        txt_q = self.txt_attn.norm(txt_q, None, txt_v)
-        txt_k = self.txt_attn.norm(None, txt_k, txt_v)
+        self.txt_attn.get_qkv(txt_modulated, qkv[:, :txt_len])
+        del txt_modulated
 
         # run actual attention
-        q = torch.cat((txt_q, img_q), dim=2)
-        del txt_q, img_q
-        k = torch.cat((txt_k, img_k), dim=2)
-        del txt_k, img_k
-        v = torch.cat((txt_v, img_v), dim=2)
-        del txt_v, img_v
-
-        qkv_list = [q, k, v]
-        del q, k, v
-        attn = attention(qkv_list, pe=pe)
+        attn = attention(qkv, pe=pe)
+        del qkv
 
-        txt_attn, img_attn = attn[:, : txt.shape[1]], attn[:, txt.shape[1] :]
+        txt_attn, img_attn = attn.narrow(1, 0, txt_len), attn.narrow(1, txt_len, attn.shape[1] - txt_len)
 
         # calculate the img blocks
-        img.addcmul_(self.img_attn.proj(img_attn), img_mod1.gate)
-        mod_img = self.img_norm2(img)
-        mod_img.mul_(1 + img_mod2.scale)
-        mod_img.add_(img_mod2.shift)
-        mod_img = split_mlp(self.img_mlp, mod_img)
-        # mod_img = self.img_mlp(mod_img)
-        img.addcmul_( mod_img, img_mod2.gate)
+        img.addcmul_(self.img_attn.proj(img_attn), img_mod[:, 2:3])
+        mod_img = modulate_(self.img_norm2(img), img_mod[:, 3:4], img_mod[:, 4:5])
+        split_mlp(self.img_mlp, mod_img, img_mod[:, 5:6], img)
+        # img.addcmul_(self.img_mlp(mod_img), img_mod[:, 5:6])
         mod_img = None
 
         # calculate the txt blocks
-        txt.addcmul_(self.txt_attn.proj(txt_attn), txt_mod1.gate)
-        txt.addcmul_(self.txt_mlp((1 + txt_mod2.scale) * self.txt_norm2(txt) + txt_mod2.shift), txt_mod2.gate)
+        txt.addcmul_(self.txt_attn.proj(txt_attn), txt_mod[:, 2:3])
+        txt.addcmul_(self.txt_mlp(modulate_(self.txt_norm2(txt), txt_mod[:, 3:4], txt_mod[:, 4:5])), txt_mod[:, 5:6])
         return img, txt
 
 
@@ -254,7 +259,7 @@ class SingleStreamBlock(nn.Module):
         super().__init__()
         self.hidden_dim = hidden_size
         self.num_heads = num_heads
-        head_dim = hidden_size // num_heads
+        self.head_dim = head_dim = hidden_size // num_heads
         self.scale = qk_scale or head_dim**-0.5
 
         self.mlp_hidden_dim = int(hidden_size * mlp_ratio)
@@ -272,46 +277,43 @@ class SingleStreamBlock(nn.Module):
         self.modulation = Modulation(hidden_size, double=False)
 
     def forward(self, x: Tensor, vec: Tensor, pe: Tensor) -> Tensor:
-        mod, _ = self.modulation(vec)
-        x_mod = self.pre_norm(x)
-        x_mod.mul_(1 + mod.scale)
-        x_mod.add_(mod.shift)
+        # vec has already been activated once for all the blocks (see Flux.forward)
+        mod = self.modulation(vec, silu_applied=True)
+        x_mod = modulate_(self.pre_norm(x), mod[:, 0:1], mod[:, 1:2])
 
         ##### More spagheti VRAM optimizations done by DeepBeepMeep !
         # I am sure you are a nice person and as you copy this code, you will give me proper credits:
         # Please link to https://github.com/deepbeepmeep/Wan2GP and @deepbeepmeep on twitter  
 
-        # x_mod = (1 + mod.scale) * x + mod.shift
+        # x_mod = scale_p1 * x + shift
 
-        shape = (*x_mod.shape[:2], self.num_heads, int(x_mod.shape[-1] / self.num_heads) )
-        q = self.linear1_attn_q(x_mod).view(*shape).transpose(1,2)
-        k = self.linear1_attn_k(x_mod).view(*shape).transpose(1,2)
-        v = self.linear1_attn_v(x_mod).view(*shape).transpose(1,2)
+        # linear1 has been split in linear1_attn_q / k / v & linear1_mlp by offload.split_linear_modules (see get_linear_split_map)
+        shape = x_mod.shape[:2] + (self.num_heads, self.head_dim)
+        q = self.linear1_attn_q(x_mod).view(*shape)
+        k = self.linear1_attn_k(x_mod).view(*shape)
+        v = self.linear1_attn_v(x_mod).view(*shape)
+        qkv = torch.empty((*shape[:2], 3, *shape[2:]), dtype=v.dtype, device=v.device)
+        qkv[:, :, 2] = v
 
-        q = self.norm(q, None, v)
-        k = self.norm(None, k, v)
+        # q & k are normalized in place in the packed qkv
+        self.norm(q, k, qkv[:, :, 0], qkv[:, :, 1])
+        del q, k, v
 
         # compute attention
-        qkv_list = [q, k, v]
-        del q, k, v
-        attn = attention(qkv_list, pe=pe)
-        # compute activation in mlp stream, cat again and run second linear layer
-
-        x_mod_shape = x_mod.shape
-        x_mod = x_mod.view(-1, x_mod.shape[-1])
-        chunk_size = int(x_mod_shape[1]/6)
-        x_chunks = torch.split(x_mod, chunk_size)
-        attn = attn.view(-1, attn.shape[-1])
-        attn_chunks =torch.split(attn, chunk_size)
-        for x_chunk, attn_chunk in zip(x_chunks, attn_chunks):
-            mlp_chunk = self.linear1_mlp(x_chunk)
-            mlp_chunk = self.mlp_act(mlp_chunk)
+        attn = attention(qkv, pe=pe)
+        del qkv
+        # compute activation in mlp stream, cat again and run second linear layer, whose gated output is directly accumulated in x (see split_mlp)
+        chunk_size = max(x_mod.shape[1] // 6, 1)
+        x_mod_chunks = torch.split(x_mod, chunk_size, dim=1)
+        attn_chunks = torch.split(attn, chunk_size, dim=1)
+        x_chunks = torch.split(x, chunk_size, dim=1)
+        gate = mod[:, 2:3]
+        for x_mod_chunk, attn_chunk, x_chunk in zip(x_mod_chunks, attn_chunks, x_chunks):
+            mlp_chunk = self.mlp_act(self.linear1_mlp(x_mod_chunk))
             attn_mlp_chunk = torch.cat((attn_chunk, mlp_chunk), -1)
             del attn_chunk, mlp_chunk 
-            x_chunk[...] = self.linear2(attn_mlp_chunk)
+            x_chunk.addcmul_(self.linear2(attn_mlp_chunk), gate)
             del attn_mlp_chunk
-        x_mod = x_mod.view(x_mod_shape)
-        x.addcmul_(x_mod, mod.gate)
         return x
 
 
@@ -324,6 +326,6 @@ class LastLayer(nn.Module):
 
     def forward(self, x: Tensor, vec: Tensor) -> Tensor:
         shift, scale = self.adaLN_modulation(vec).chunk(2, dim=1)
-        x = (1 + scale[:, None, :]) * self.norm_final(x) + shift[:, None, :]
+        x = modulate_(self.norm_final(x), shift[:, None, :], scale[:, None, :] + 1)
         x = self.linear(x)
         return x